@@ -1,12 +1,29 @@
 import os
+import asyncio
+import contextlib
+import functools
+import hashlib
 import json
 import logging
-from telegram import Update
+import time
+import unicodedata
+from collections import deque
+from telegram import Bot, Message, Update
+from telegram.constants import ChatAction, MessageLimit
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackContext
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, select, text
-from sqlalchemy.orm import declarative_base, sessionmaker
-from datetime import datetime
+from sqlalchemy import event, Column, Index, Integer, String, DateTime, LargeBinary, TextClause, insert, select, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from datetime import datetime, timedelta
+import httpx
+import numpy as np
 import openai
+from openai.types.chat import ChatCompletion
+import orjson
+import sqlglot
+from sqlglot import exp
 from config import OPENAI_API_KEY, TELEGRAM_BOT_TOKEN
 
 # Configure logging
@@ -21,45 +38,106 @@ Base = declarative_base()
 
 class GymNote(Base):
     __tablename__ = 'gym_notes'
+    __table_args__ = (Index('ix_gym_notes_user_ts', 'user_id', 'timestamp'),)
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
     note = Column(String)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+class LLMCache(Base):
+    __tablename__ = 'llm_cache'
+    key = Column(String, primary_key=True)
+    # ChatCompletion serialized as JSON, which unlike a pickle survives openai upgrades
+    value = Column(String)
+    ts = Column(DateTime, default=datetime.utcnow)
+
+class SQLCache(Base):
+    __tablename__ = 'sql_cache'
+    user_id = Column(Integer, primary_key=True)
+    prompt_norm = Column(String, primary_key=True)
+    # Hash of the query prompt, so cached queries are invalidated when the schema description changes
+    schema_key = Column(String, primary_key=True)
+    sql_query = Column(String)
+    # float32 embedding of prompt_norm, used for the semantic similarity lookup
+    embedding = Column(LargeBinary)
+    ts = Column(DateTime, default=datetime.utcnow)
+
 # Ensure the database file is in the correct location
-db_path = 'sqlite:///gym_notes.db'
+db_path = 'sqlite+aiosqlite:///gym_notes.db'
+
+# Older SQLAlchemy 2.0 releases default aiosqlite file databases to NullPool, which rejects the pool sizing
+engine = create_async_engine(
+    db_path,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True
+)
 
-engine = create_engine(db_path)
-Base.metadata.create_all(engine)
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use WAL so readers don't block on writers, and keep the hot pages in memory."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
 
-Session = sessionmaker(bind=engine)
-session = Session()
+# Notes are written through the Core rather than the ORM; the column defaults (timestamp) still apply
+INSERT_NOTE_STMT = insert(GymNote.__table__)
+
+# Every handler opens its own short-lived session from this factory
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+async def init_db(application) -> None:
+    """Create the database tables before the bot starts polling."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # create_all skips indexes of tables that already exist, so add them to older databases explicitly
+        for index in GymNote.__table__.indexes:
+            await conn.run_sync(index.create, checkfirst=True)
+
+# A single HTTP client is shared by all outbound requests so keep-alive connections and DNS lookups are reused
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+)
 
 # Set up OpenAI
-openai.api_key = OPENAI_API_KEY
+client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
 
-async def error_handler(update: object, context: CallbackContext):
-    # Log the error before we do anything else, so we can see it even if something breaks.
-    print(f'Update {update} caused error {context.error}')
+# Bounds the number of OpenAI requests in flight across all users, which keeps bursts under the rate limit
+MAX_OPENAI_CONCURRENCY = 16
+openai_slots = asyncio.Semaphore(MAX_OPENAI_CONCURRENCY)
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send a message when the command /start is issued."""
-    await update.message.reply_text('Hi! Use /note to add a gym note or /query to ask a question.')
+async def create_completion(**kwargs):
+    """Create a chat completion once one of the OpenAI slots is free."""
+    async with openai_slots:
+        return await client.chat.completions.create(**kwargs)
 
-async def parse_gym_note(note: str) -> dict:
-    """Use OpenAI to parse the gym note, extract relevant information, and identify missing details."""
+async def stream_completion(**kwargs):
+    """Stream a chat completion's chunks, holding an OpenAI slot until the stream is consumed."""
+    async with openai_slots:
+        stream = await client.chat.completions.create(stream=True, **kwargs)
+        async for chunk in stream:
+            yield chunk
 
-    content = (
+async def create_embedding(**kwargs):
+    """Create an embedding once one of the OpenAI slots is free."""
+    async with openai_slots:
+        return await client.embeddings.create(**kwargs)
 
-    )
+async def close_http_client(application) -> None:
+    """Close the shared HTTP client when the bot shuts down."""
+    await application.bot_data['http'].aclose()
 
-    logger.info("Sending request to OpenAI to parse gym note")
-    response = await openai.ChatCompletion.acreate(
-        model="gpt-4",
-        messages=[
-            {
-                "role": "system",
-                "content": """You are a helpful gym assistant. Users will provide gym notes to you,
+# Static prompts are built once so every request sends byte-identical system messages,
+# which also lets the provider-side prompt cache hit
+SYSTEM_PARSE_PROMPT = """You are a helpful gym assistant. Users will provide gym notes to you,
      describing exercises they performed. Your task is to parse this info and
       return it in a standardized JSON object with the following fields:
        exercise: name or description of exercise
@@ -71,10 +149,230 @@ async def parse_gym_note(note: str) -> dict:
        For example:
       '{"exercise": "low cable pull", "sets": 4, "reps": [10, 12, 12, 12], "weight": [5, 10, 15, 15], '
       '"duration": "", "notes": "easy"}\n'
-      If no information is available for a certain field, just leave it empty. Return only
-      the JSON string with no additional comments or notes. Convert all fields to standard
-      SI units (when applicable) and lowercase the name of the exercise. Since the notes can
-      have multiple exercises, always return an array of objects in the JSON string."""
+      If no information is available for a certain field, just leave it empty. Convert all
+      fields to standard SI units (when applicable) and lowercase the name of the exercise.
+      Since the notes can have multiple exercises, always pass an array of objects to the
+      save_exercises function."""
+
+# Function spec the parse model is forced to call, so its output is always structured JSON
+SAVE_EXERCISES_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "save_exercises",
+        "description": "Save the exercises described in a gym note.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "exercises": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "exercise": {"type": "string", "description": "name or description of exercise"},
+                            "sets": {"type": "integer", "description": "number of sets performed"},
+                            "reps": {"type": "array", "items": {"type": "integer"}, "description": "reps for each set"},
+                            "weight": {"type": "array", "items": {"type": "number"}, "description": "weight for each set"},
+                            "duration": {"type": "string", "description": "time spent in total, usually only for cardio exercises"},
+                            "notes": {"type": "string", "description": "some general extra notes"}
+                        },
+                        "required": ["exercise", "sets", "reps", "weight", "duration", "notes"]
+                    }
+                }
+            },
+            "required": ["exercises"]
+        }
+    }
+}
+
+# Describe the database schema to the model
+DB_SCHEMA = """
+    A database has a table named 'gym_notes' with the following columns:
+    - id (Integer, primary key)
+    - user_id (Integer)
+    - note (String)
+    - timestamp (DateTime)
+    The field contains a JSON string describing a (gym) exercise set. It has the fields:
+      exercise: name or description of exercise
+      sets: integer, number of sets performed
+      reps: array of reps for each sets
+      weight: array with weight for each set
+      duration: time spent in total, usually only for cardio exercises
+      notes: some general extra notes in a string
+    For example:
+    {"exercise": "low cable pull", "sets": 4, "reps": [10, 12, 12, 12], "weight": [5, 10, 15, 15], "duration": "", "notes": ""}
+    """
+
+SYSTEM_QUERY_PROMPT = f"You are a helpful assistant. {DB_SCHEMA}"
+
+SYSTEM_SUMMARY_PROMPT = "You are a helpful assistant. Your task is to help a user with exercise questions. You will receive data from a database of exercises the user has performed before."
+
+SQL_CACHE_SCHEMA_KEY = hashlib.sha256(SYSTEM_QUERY_PROMPT.encode('utf-8')).hexdigest()
+
+# Prompts whose embedding is at least this similar to a cached one reuse its SQL query
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Tables generated queries are allowed to read from
+QUERYABLE_TABLES = {'gym_notes'}
+
+# Table-valued functions generated queries may use to unpack the JSON in gym_notes.note
+QUERYABLE_TABLE_FUNCTIONS = {'json_each', 'json_tree'}
+
+# Upper bound on the rows passed on to the summarization model
+MAX_QUERY_ROWS = 200
+
+# Each user may issue at most this many OpenAI-backed commands per window (in seconds)
+RATE_LIMIT_REQUESTS = 10
+RATE_LIMIT_WINDOW = 60
+
+# Timestamps of each user's recent OpenAI-backed commands, ordered by the user's latest request
+recent_requests = {}
+
+# Seconds between typing indicators and between edits of a streamed reply; Telegram allows
+# about one message edit per second in a chat before answering with flood control errors
+TYPING_INTERVAL = 4
+STREAM_EDIT_INTERVAL = 1.5
+
+# Parameters that don't influence the completion itself and must not be part of the cache key
+NON_OUTPUT_PARAMS = {'stream', 'user', 'api_key'}
+
+def llm_cache_key(**kwargs) -> str:
+    """Build a SHA-256 cache key from the normalized (model, messages, temperature, ...) request."""
+    params = {k: v for k, v in kwargs.items() if k not in NON_OUTPUT_PARAMS}
+    params['messages'] = [
+        {**message, 'content': unicodedata.normalize('NFC', message['content']).strip().lower()}
+        for message in params.get('messages', [])
+    ]
+    payload = orjson.dumps(params, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+async def cached_create(parse, **kwargs):
+    """Create a chat completion, serving identical requests from the database, and return parse(response).
+
+    A response is only cached once parse accepted it, so a response the caller rejects is requested again next time.
+    """
+    key = llm_cache_key(**kwargs)
+    async with AsyncSessionLocal() as session:
+        cached = await session.get(LLMCache, key)
+    if cached is not None:
+        try:
+            response = ChatCompletion.model_validate_json(cached.value)
+        except ValueError:
+            logger.warning("Ignoring unreadable LLM cache entry %s", key)
+        else:
+            logger.info("LLM cache hit for key %s", key)
+            return parse(response)
+
+    response = await create_completion(**kwargs)
+    result = parse(response)
+    async with AsyncSessionLocal() as session:
+        await session.merge(LLMCache(key=key, value=response.model_dump_json()))
+        await session.commit()
+    return result
+
+async def error_handler(update: object, context: CallbackContext):
+    # Log the error before we do anything else, so we can see it even if something breaks.
+    logger.error("Update %s caused error", update, exc_info=context.error)
+    if isinstance(update, Update) and update.effective_message:
+        await update.effective_message.reply_text('Sorry, something went wrong while handling your message. Please try again later.')
+
+def is_rate_limited(user_id: int) -> bool:
+    """Record a request for the user and tell whether they exceeded the rate limit."""
+    now = time.monotonic()
+    # Forget users without requests in the window, so the map only holds recently active users
+    while recent_requests:
+        oldest_user = next(iter(recent_requests))
+        if now - recent_requests[oldest_user][-1] <= RATE_LIMIT_WINDOW:
+            break
+        del recent_requests[oldest_user]
+
+    timestamps = recent_requests.get(user_id, deque())
+    while timestamps and now - timestamps[0] > RATE_LIMIT_WINDOW:
+        timestamps.popleft()
+    if len(timestamps) >= RATE_LIMIT_REQUESTS:
+        # No new request is recorded, so the user keeps their place in the map
+        return True
+
+    # Move the user to the end along with the new timestamp, keeping the map ordered by latest request
+    recent_requests.pop(user_id, None)
+    timestamps.append(now)
+    recent_requests[user_id] = timestamps
+    return False
+
+def command_args(update: Update) -> str:
+    """Return the message text after the command, also for /command@botname and multi-line messages."""
+    parts = update.message.text.split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ""
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send a message when the command /start is issued."""
+    await update.message.reply_text('Hi! Use /note to add a gym note or /query to ask a question.')
+
+async def keep_typing(bot: Bot, chat_id: int) -> None:
+    """Show the typing indicator until cancelled; Telegram clears it after about 5 seconds."""
+    while True:
+        try:
+            await bot.send_chat_action(chat_id, ChatAction.TYPING)
+        except TelegramError as e:
+            # The indicator is cosmetic, so a failed update must not end the task
+            logger.warning("Failed to send typing action: %s", e)
+        await asyncio.sleep(TYPING_INTERVAL)
+
+def clamp_message(text: str) -> str:
+    """Truncate text to the maximum length of a Telegram message."""
+    if len(text) <= MessageLimit.MAX_TEXT_LENGTH:
+        return text
+    return text[:MessageLimit.MAX_TEXT_LENGTH - 1] + "…"
+
+async def stream_to_message(message: Message, stream) -> tuple[Message, str]:
+    """Collect a streamed completion, editing the message with the partial text as it arrives.
+
+    Returns the last edited version of the message together with the full completion text.
+    """
+    text_so_far = ""
+    last_edit = asyncio.get_running_loop().time()
+    # Close the stream on errors right away, so its OpenAI slot and HTTP response aren't held until GC
+    async with contextlib.aclosing(stream):
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            text_so_far += chunk.choices[0].delta.content
+            now = asyncio.get_running_loop().time()
+            partial_text = clamp_message(text_so_far.strip())
+            if now - last_edit >= STREAM_EDIT_INTERVAL and partial_text != message.text:
+                last_edit = now
+                try:
+                    message = await message.edit_text(partial_text)
+                except TelegramError as e:
+                    # Partial edits are best effort; the full text is sent once the stream ends
+                    logger.warning("Skipping partial reply edit: %s", e)
+    return message, text_so_far.strip()
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Return the flood control wait of a RetryAfter error in seconds."""
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return error.retry_after
+
+def parse_exercises(response: ChatCompletion) -> list[dict]:
+    """Extract the exercises from the save_exercises call in a parse response."""
+    parsed_text = response.choices[0].message.tool_calls[0].function.arguments
+    logger.info("Received response from OpenAI: %s", parsed_text)
+    return orjson.loads(parsed_text)["exercises"]
+
+async def parse_gym_note(note: str) -> list[dict]:
+    """Use OpenAI to parse the gym note, extract relevant information, and identify missing details."""
+
+    logger.info("Sending request to OpenAI to parse gym note")
+    return await cached_create(
+        parse_exercises,
+        model="gpt-4o-mini",
+        tools=[SAVE_EXERCISES_TOOL],
+        tool_choice={"type": "function", "function": {"name": "save_exercises"}},
+        messages=[
+            {
+                "role": "system",
+                "content": SYSTEM_PARSE_PROMPT
             },
             {
                 "role": "user",
@@ -85,105 +383,246 @@ async def parse_gym_note(note: str) -> dict:
             }
         ]
     )
-    parsed_text = response.choices[0].message['content'].strip()
-    logger.info(f"Received response from OpenAI: {parsed_text}")
-
-    try:
-        parsed_notes = json.loads(parsed_text)
-    except json.JSONDecodeError as e:
-        err_str = f"Failed to parse JSON from the model's response: {str(e)}"
-        logger.error(err_str)
-        raise ValueError(err_str)
-
-    return parsed_notes
 
 async def note_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Save the gym note to the database."""
     user_id = update.message.from_user.id
-    note = update.message.text[len('/note '):]  # Remove the command part
+    if is_rate_limited(user_id):
+        await update.message.reply_text('You are sending too many requests, please slow down and try again in a minute.')
+        return
+    note = command_args(update)
 
     # Parse the gym note using OpenAI API
     parsed_notes = await parse_gym_note(note)
 
-    # Save the parsed note to the database
-    for exercise in parsed_notes:
-      gym_note = GymNote(user_id=user_id, note=json.dumps(exercise))
-      session.add(gym_note)
-      session.commit()
+    # An empty parameter list would make execute() insert a single row of defaults
+    if not parsed_notes:
+        await update.message.reply_text('No exercises found in the note, nothing to save.')
+        return
 
-      # Inform the user about the saved details
-      saved_details = "\n".join([f"{key}: {value}" for key, value in exercise.items()])
-      await update.message.reply_text(f'Note saved with the following details:\n{saved_details}')
-      logger.info(f'Note saved for user {user_id} with details: {saved_details}')
+    # Save all parsed exercises to the database with a single executemany in one transaction
+    async with engine.begin() as conn:
+        await conn.execute(
+            INSERT_NOTE_STMT,
+            # Stored with json.dumps, whose spacing and \u escapes match the existing rows and DB_SCHEMA example
+            [{"user_id": user_id, "note": json.dumps(exercise)} for exercise in parsed_notes]
+        )
 
-async def query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /query command by forwarding the user's prompt to OpenAI and executing the generated query."""
-    user_id = update.message.from_user.id
-    prompt = update.message.text[len('/query '):]  # Remove the command part
+    # Inform the user about the saved details in a single reply
+    saved_details = "\n\n".join(
+        "\n".join(f"{key}: {value}" for key, value in exercise.items())
+        for exercise in parsed_notes
+    )
+    # The rows are already committed, so a long note must not make the confirmation fail
+    await update.message.reply_text(clamp_message(f'Note saved with the following details:\n{saved_details}'))
+    logger.info('Note saved for user %s with details: %s', user_id, saved_details)
 
-    # Describe the database schema to the model
-    db_schema = """
-    A database has a table named 'gym_notes' with the following columns:
-    - id (Integer, primary key)
-    - user_id (Integer)
-    - note (String)
-    - timestamp (DateTime)
-    The field contains a JSON string describing a (gym) exercise set. It has the fields:
-      exercise: name or description of exercise
-      sets: integer, number of sets performed
-      reps: array of reps for each sets
-      weight: array with weight for each set
-      duration: time spent in total, usually only for cardio exercises
-      notes: some general extra notes in a string
-    For example:
-    {"exercise": "low cable pull", "sets": 4, "reps": [10, 12, 12, 12], "weight": [5, 10, 15, 15], "duration": "", "notes": ""}
+async def embed_prompt(prompt_norm: str) -> np.ndarray:
+    """Embed a normalized prompt with a cheap embedding model."""
+    response = await create_embedding(model=EMBEDDING_MODEL, input=prompt_norm)
+    return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+async def lookup_exact_sql(user_id: int, prompt_norm: str) -> str | None:
+    """Find the cached SQL query for exactly this normalized prompt."""
+    async with AsyncSessionLocal() as session:
+        cached = await session.get(SQLCache, (user_id, prompt_norm, SQL_CACHE_SCHEMA_KEY))
+    if cached is None:
+        return None
+    logger.info("SQL cache hit for prompt: %s", prompt_norm)
+    return cached.sql_query
+
+async def lookup_similar_sql(user_id: int, prompt_norm: str, embedding: np.ndarray) -> str | None:
+    """Find the cached SQL query of the most similar earlier prompt, if it is similar enough."""
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(SQLCache.sql_query, SQLCache.embedding)
+            .where(SQLCache.user_id == user_id, SQLCache.schema_key == SQL_CACHE_SCHEMA_KEY)
+        )
+        rows = result.all()
+    if not rows:
+        return None
+
+    matrix = np.vstack([np.frombuffer(row.embedding, dtype=np.float32) for row in rows])
+    similarities = np.dot(matrix, embedding) / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(embedding))
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    logger.info("Semantic SQL cache hit for prompt: %s (similarity %.3f)", prompt_norm, similarities[best])
+    return rows[best].sql_query
+
+@functools.lru_cache(maxsize=1024)
+def compiled_sql(sql_query: str) -> TextClause:
+    """Build the TextClause for a SQL string once; cached queries repeat the same strings."""
+    return text(sql_query)
+
+def limit_sql(sql_query: str) -> str:
+    """Cap the outer LIMIT of a validated query at MAX_QUERY_ROWS, keeping a smaller existing limit."""
+    parsed = sqlglot.parse_one(sql_query, read='sqlite')
+    limit = MAX_QUERY_ROWS
+    existing = parsed.args.get('limit')
+    if existing is not None and isinstance(existing.expression, exp.Literal) and existing.expression.is_int:
+        # A negative LIMIT means no limit in SQLite
+        requested = int(existing.expression.this)
+        if 0 <= requested < MAX_QUERY_ROWS:
+            limit = requested
+    return parsed.limit(limit).sql(dialect='sqlite')
+
+def validate_sql(sql_query: str) -> None:
+    """Reject generated SQL that isn't a single SELECT on the queryable tables, before it reaches the database."""
+    try:
+        parsed = sqlglot.parse_one(sql_query, read='sqlite')
+    except sqlglot.errors.ParseError as e:
+        raise ValueError(f"Generated query is not valid SQL: {e}")
+    if not isinstance(parsed, (exp.Select, exp.Union, exp.Intersect, exp.Except)):
+        raise ValueError(f"Generated query is not a SELECT statement: {sql_query}")
+    # SQLite compares table and function names case-insensitively, so all names are lowercased
+    # CTE names show up as tables but read no other tables
+    cte_names = {cte.alias_or_name.lower() for cte in parsed.find_all(exp.CTE)}
+    shadowed = cte_names & (set(Base.metadata.tables) - QUERYABLE_TABLES)
+    if shadowed:
+        raise ValueError(f"Generated query defines CTEs named after other tables: {', '.join(sorted(shadowed))}")
+
+    tables = set()
+    for table in parsed.find_all(exp.Table):
+        if isinstance(table.this, exp.Func):
+            # Table-valued functions such as pragma_table_info() could expose internal tables
+            function = table.this
+            function_name = (function.name if isinstance(function, exp.Anonymous) else function.sql_name()).lower()
+            if function_name not in QUERYABLE_TABLE_FUNCTIONS:
+                raise ValueError(f"Generated query uses an unexpected table function: {function_name}")
+        elif table.name.lower() not in cte_names:
+            tables.add(table.name.lower())
+    if not tables <= QUERYABLE_TABLES:
+        raise ValueError(f"Generated query reads from unexpected tables: {', '.join(sorted(tables - QUERYABLE_TABLES))}")
+
+async def store_cached_sql(user_id: int, prompt_norm: str, sql_query: str, embedding: np.ndarray) -> None:
+    """Cache a SQL query that executed successfully, so identical and similar prompts can reuse it."""
+    async with AsyncSessionLocal() as session:
+        await session.merge(SQLCache(
+            user_id=user_id,
+            prompt_norm=prompt_norm,
+            schema_key=SQL_CACHE_SCHEMA_KEY,
+            sql_query=sql_query,
+            embedding=embedding.tobytes()
+        ))
+        await session.commit()
+
+async def generate_sql(user_id: int, prompt_norm: str, prompt: str) -> tuple[str, np.ndarray | None]:
+    """Return a SQL query answering the prompt, reusing the query of an identical or similar earlier prompt.
+
+    For a newly generated query the prompt embedding is returned as well, so the caller can cache the query
+    once it has executed successfully; for a cached query it is None.
     """
+    sql_query = await lookup_exact_sql(user_id, prompt_norm)
+    if sql_query is not None:
+        return sql_query, None
+
+    embedding = await embed_prompt(prompt_norm)
+    sql_query = await lookup_similar_sql(user_id, prompt_norm, embedding)
+    if sql_query is not None:
+        return sql_query, None
 
     logger.info("Sending request to OpenAI to generate a SQL query")
-    # Use OpenAI to generate a SQL query based on the user's prompt
-    response = await openai.ChatCompletion.acreate(
+    # Use OpenAI to generate a SQL query based on the user's prompt; sql_cache already caches
+    # queries that ran successfully, so the response itself is not cached
+    response = await create_completion(
         model="gpt-4",
         messages=[
-            {"role": "system", "content": f"You are a helpful assistant. {db_schema}"},
+            {"role": "system", "content": SYSTEM_QUERY_PROMPT},
             {"role": "user", "content": f" Given user ID = {user_id}. Generate an SQL query to fetch data from the gym_notes table that could help to answer the questions in the user prompt. Make sure you follow the specified schema to generate a correct query. [prompt: {prompt}] Return only the raw SQL query, without any comments or remarks, so it can be used directly to query the SQLite database."}
         ]
     )
-    sql_query = response.choices[0].message['content'].strip()
-    logger.info(f"Generated SQL query from OpenAI: {sql_query}")
+    sql_query = response.choices[0].message.content.strip()
+    logger.info("Generated SQL query from OpenAI: %s", sql_query)
+    validate_sql(sql_query)
+    return sql_query, embedding
+
+async def generate_and_run_sql(user_id: int, prompt: str) -> tuple[list, str]:
+    """Generate, validate and execute the SQL query for a prompt, returning at most MAX_QUERY_ROWS rows and the query."""
+    prompt_norm = prompt.lower().strip()
+    generated_query, embedding = await generate_sql(user_id, prompt_norm, prompt)
+    sql_query = limit_sql(generated_query)
+
+    # Stream the result so no more than MAX_QUERY_ROWS rows are ever fetched from the cursor.
+    # The session is released before returning so the connection isn't held during follow-up OpenAI calls
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(compiled_sql(sql_query))
+        rows = await result.fetchmany(MAX_QUERY_ROWS)
+        await result.close()
+
+    # Only cache queries that ran, so a broken query isn't replayed for this and similar prompts
+    if embedding is not None:
+        await store_cached_sql(user_id, prompt_norm, generated_query, embedding)
+    return rows, sql_query
+
+async def query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /query command by forwarding the user's prompt to OpenAI and executing the generated query."""
+    user_id = update.message.from_user.id
+    if is_rate_limited(user_id):
+        await update.message.reply_text('You are sending too many requests, please slow down and try again in a minute.')
+        return
+    prompt = command_args(update)
+
+    # Let the user know we're working on it while OpenAI is busy
+    reply = await update.message.reply_text('Working on it...')
+    typing_task = asyncio.create_task(keep_typing(context.bot, update.effective_chat.id))
+    try:
+        await answer_query(reply, user_id, prompt)
+    finally:
+        typing_task.cancel()
 
+async def answer_query(reply: Message, user_id: int, prompt: str) -> None:
+    """Generate and execute a SQL query for the prompt, then stream the summarized answer into the reply."""
     summary = ""
-    # Execute the generated SQL query
     try:
-        result = session.execute(text(sql_query))
-        result_rows = result.fetchall()
+        result_rows, sql_query = await generate_and_run_sql(user_id, prompt)
         if not result_rows:
             logger.info("Query returned no results.")
-            result_text = "Query returned no results."
+            summary = "Query returned no results."
         else:
             result_text = "\n".join(str(row) for row in result_rows)
-            logger.info(f"Query results: {result_text}")
+            # Query results can be large, so only log them when debugging
+            logger.debug("Query results: %s", result_text)
 
             logger.info("Sending query results to OpenAI for summarization")
             # Summarize the results using OpenAI
-            summary_response = await openai.ChatCompletion.acreate(
+            summary_stream = stream_completion(
                 model="gpt-4",
                 messages=[
-                    {"role": "system", "content": "You are a helpful assistant. Your task is to help a user with exercise questions. You will receive data from a database of exercises the user has performed before."},
+                    {"role": "system", "content": SYSTEM_SUMMARY_PROMPT},
                     {"role": "user", "content": f" Using data: {result_text}. Answer the question in the user prompt: {prompt}."}
                 ]
             )
-            summary = summary_response.choices[0].message['content'].strip()
-            logger.info(f"Received summary from OpenAI: {summary}")
+            reply, summary = await stream_to_message(reply, summary_stream)
+            logger.info("Received summary from OpenAI: %s", summary)
+            if not summary:
+                # Never fall back to the raw rows; they are not meant for the user and may exceed the message limit
+                summary = "Sorry, I couldn't summarize the results for your question."
+    except ValueError as e:
+        logger.error("Rejected generated query: %s", e)
+        summary = f"Could not answer the question: {e}"
+    except TelegramError:
+        # Failures to talk to Telegram aren't query errors; leave them to the error handler
+        raise
     except Exception as e:
-        logger.error(f"An error occurred while executing the query: {e}")
+        logger.error("An error occurred while executing the query: %s", e)
         summary = f"An error occurred while executing the query: {e}"
 
     # Return the summarized results to the user
-    await update.message.reply_text(f'{summary}')
+    final_text = clamp_message(summary)
+    if final_text != reply.text:
+        try:
+            await reply.edit_text(final_text)
+        except RetryAfter as e:
+            # Wait out flood control once rather than losing the answer
+            await asyncio.sleep(retry_after_seconds(e))
+            await reply.edit_text(final_text)
 
 def main() -> None:
     """Start the bot."""
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    # Process updates concurrently so one slow OpenAI round-trip doesn't block other users
+    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(32).post_init(init_db).post_shutdown(close_http_client).build()
+    application.bot_data['http'] = http_client
 
     application.add_error_handler(error_handler);
 
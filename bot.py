@@ -19,6 +19,11 @@ Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 session = Session()
 
+def command_args(update: Update) -> str:
+    """Return the message text after the command, also for /command@botname and multi-line messages."""
+    parts = update.message.text.split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ""
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     await update.message.reply_text('Hi! Use /note to add a gym note.')
@@ -26,7 +31,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def note_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Save the gym note to the database."""
     user_id = update.message.from_user.id
-    note = update.message.text[len('/note '):]  # Remove the command part
+    note = command_args(update)
 
     gym_note = GymNote(user_id=user_id, note=note)
     session.add(gym_note)
@@ -5,7 +5,13 @@ pkgs.mkShellNoCC {
     (python3.withPackages (ps: [
       ps.python-telegram-bot
       ps.sqlalchemy
+      ps.aiosqlite
       ps.openai
+      ps.httpx
+      ps.h2
+      ps.numpy
+      ps.sqlglot
+      ps.orjson
     ]))
   ];
 }